@@ -1,7 +1,12 @@
 
 # ap.py
 import os
+import functools
 import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, date, timedelta
 from dotenv import load_dotenv
 import streamlit as st
@@ -23,18 +28,103 @@ load_dotenv()
 TWILIO_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")  # e.g. +91XXXXXXXXXX
+# Optional webhook Twilio pushes delivery/status changes to, instead of us polling per sid.
+# The receiver should verify the request with twilio.request_validator.RequestValidator and
+# log it as a call_logs row (event "delivery_status") for the loan_id query parameter.
+TWILIO_STATUS_CALLBACK_URL = os.getenv("TWILIO_STATUS_CALLBACK_URL")
 USE_TWILIO = bool(TWILIO_SID and TWILIO_AUTH and TWILIO_NUMBER and Client is not None)
 
-if USE_TWILIO:
-    tw_client = Client(TWILIO_SID, TWILIO_AUTH)
-else:
-    tw_client = None
+@st.cache_resource
+def get_twilio_client():
+    """Build the Twilio client once per process on a keep-alive session, so bulk sends reuse TLS connections."""
+    # requests/urllib3 ship with the twilio package, so import them only when it is in use
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    client = Client(TWILIO_SID, TWILIO_AUTH)
+    # Retry only where Twilio can't have acted: connection failures and 429. A read error or
+    # 5xx on POST may already have placed the call or sent the SMS, so read/other are 0.
+    retry = Retry(total=3, connect=3, read=0, other=0, status=3, backoff_factor=0.2,
+                  status_forcelist=[429], allowed_methods=None)
+    session = Session()
+    session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=retry))
+    client.http_client.session = session
+    return client
+
+tw_client = get_twilio_client() if USE_TWILIO else None
+
+# --- Twilio rate limiting ---
+# Twilio rejects or queues requests above its per-number and per-account QPS limits
+PER_NUMBER_QPS = 1
+ACCOUNT_QPS = 10
+
+class RateLimiter:
+    """Sliding one-second windows of dispatch timestamps, per phone number and per account."""
+
+    def __init__(self, per_number=PER_NUMBER_QPS, account=ACCOUNT_QPS, window=1.0):
+        self.per_number = per_number
+        self.account = account
+        self.window = window
+        self._per_number = defaultdict(deque)
+        self._account = deque()
+        self._lock = threading.Lock()
+
+    def allow(self, phone):
+        """Record a dispatch to `phone` and return True if both limits have room, else False."""
+        now = time.monotonic()
+        cutoff = now - self.window
+        with self._lock:
+            number_q = self._per_number[phone]
+            for q in (number_q, self._account):
+                while q and q[0] <= cutoff:
+                    q.popleft()
+            if len(number_q) >= self.per_number or len(self._account) >= self.account:
+                return False
+            number_q.append(now)
+            self._account.append(now)
+            return True
+
+# Shared across reruns and sessions so the account-wide limit holds for the whole app
+@st.cache_resource
+def get_rate_limiter():
+    return RateLimiter()
+
+def wait_for_dispatch_slot(phone):
+    rl = get_rate_limiter()
+    while not rl.allow(phone):
+        time.sleep(0.05)
 
 DB_PATH = "emi_genie_streamlit.db"
 
 # --- Database helpers ---
+# Each thread (Streamlit script runs, bulk-call workers, the Twilio pool) gets its own
+# connection to the WAL database, so readers proceed in parallel and only writes take the lock.
+_tls = threading.local()
+
+def get_conn():
+    if not hasattr(_tls, "conn"):
+        # Autocommit at the driver level; seed_demo opens an explicit transaction
+        conn = sqlite3.connect(DB_PATH, isolation_level=None)
+        # WAL turns each commit into an append and lets reads run alongside writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        # Name-indexable rows without building a dict per row
+        conn.row_factory = sqlite3.Row
+        _tls.conn = conn
+        # One reusable cursor per connection instead of a fresh one per query
+        _tls.cursor = conn.cursor()
+    return _tls.conn
+
+def get_cursor():
+    get_conn()
+    return _tls.cursor
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn = get_conn()
     cur = conn.cursor()
     cur.execute("""
     CREATE TABLE IF NOT EXISTS customers (
@@ -63,26 +153,86 @@ def init_db():
         ts DATETIME DEFAULT CURRENT_TIMESTAMP
     )
     """)
-    conn.commit()
+    # Indexes backing the JOINs, overdue filters and the recent-logs listing
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_loans_customer ON loans(customer_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_loans_due_status ON loans(due_date, status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_loans_status ON loans(status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_calllogs_ts ON call_logs(ts DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_calllogs_loan ON call_logs(loan_id)")
     return conn
 
-conn = init_db()
+init_db()
+
+@functools.lru_cache(maxsize=64)
+def _query_all_cached(q, args):
+    return get_cursor().execute(q, args).fetchall()
 
 def query_all(q, args=()):
-    cur = conn.cursor()
-    cur.execute(q, args)
-    # Fetch column names
-    columns = [description[0] for description in cur.description]
-    # Create list of dicts
-    rows = [dict(zip(columns, row)) for row in cur.fetchall()]
-    return rows
+    # Identical SELECTs are answered from memory until the next write clears the memo;
+    # Streamlit re-executes this module on every rerun, so it never outlives one run.
+    return _query_all_cached(q, tuple(args))
 
 def execute(q, args=()):
-    cur = conn.cursor()
+    # Connection is in autocommit mode, so no explicit commit is needed here;
+    # inside a BEGIN ... COMMIT block the write joins the open transaction.
+    cur = get_cursor()
     cur.execute(q, args)
-    conn.commit()
+    clear_read_cache()
     return cur.lastrowid
 
+# INSERT ... RETURNING needs SQLite >= 3.35; older builds (e.g. Debian bullseye's 3.34) fall back to lastrowid
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+def execute_returning(q, args=()):
+    """Run an INSERT and return the new row id, fetched by the same statement where supported."""
+    if not HAS_RETURNING:
+        return execute(q, args)
+    # fetchall() steps the statement to completion so the autocommit closes
+    rows = get_cursor().execute(q + " RETURNING id", args).fetchall()
+    clear_read_cache()
+    return rows[0][0] if rows else None
+
+# Hot-path statements: passing the identical SQL string keeps sqlite3's statement cache hitting
+SQL_LOG_INSERT = "INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)"
+SQL_LOAN_CONTACT = "SELECT l.id, l.emi_amount, c.name, c.phone, c.language FROM loans l JOIN customers c ON l.customer_id = c.id WHERE l.id = ?"
+
+def read_df(q, args=(), **kwargs):
+    """Run a SELECT straight into a DataFrame, skipping the per-row Python round-trip."""
+    return pd.read_sql_query(q, get_conn(), params=args, **kwargs)
+
+# Read-only queries re-run on every Streamlit rerun; memoize them briefly
+# and drop the cache whenever we write.
+@st.cache_data(ttl=5)
+def fetch_loans():
+    return read_df("SELECT l.id, c.name, l.emi_amount, l.due_date, l.status FROM loans l JOIN customers c ON l.customer_id = c.id ORDER BY l.id DESC")
+
+@st.cache_data(ttl=5)
+def fetch_logs(limit=100):
+    return read_df("SELECT id, loan_id, event, detail, ts FROM call_logs ORDER BY ts DESC LIMIT ?", (limit,), parse_dates=["ts"])
+
+@st.cache_data(ttl=5)
+def fetch_counters(today):
+    """All dashboard counters from a single pass over loans."""
+    return dict(query_all("""
+        SELECT COUNT(*) AS total,
+               COALESCE(SUM(status='paid'), 0) AS paid,
+               COALESCE(SUM(status='rescheduled'), 0) AS resched,
+               COALESCE(SUM(status='due'), 0) AS due,
+               COALESCE(SUM(status='due' AND due_date <= ?), 0) AS overdue
+        FROM loans
+    """, (today,))[0])
+
+def clear_read_cache():
+    fetch_loans.clear()
+    fetch_logs.clear()
+    fetch_counters.clear()
+    _query_all_cached.cache_clear()
+
+# Fixed TwiML markup, built once; only the locale and message text vary per call
+TWIML_TEMPLATE = "<Response><Gather input='dtmf' timeout='5' numDigits='1'><Say language='{lang}'>{text}</Say></Gather></Response>"
+# Twilio <Say> locale per message language; unknown languages fall back to Indian English
+TTS_LANG_MAP = {"hi": "hi-IN", "en": "en-IN", "ta": "ta-IN", "bn": "bn-IN"}
+
 # --- Seed demo data ---
 def seed_demo():
     # small check to avoid duplicates
@@ -96,11 +246,23 @@ def seed_demo():
         ("Rajesh Kumar", "+919888777666", "bn"),
         ("Karthik", "+919999888777", "ta"),
     ]
-    for name, phone, lang in customers:
-        cid = execute("INSERT INTO customers (name, phone, language) VALUES (?, ?, ?)", (name, phone, lang))
+    # Insert everything in one transaction so the seed costs a single commit
+    cur = get_conn().cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.executemany("INSERT INTO customers (name, phone, language) VALUES (?, ?, ?)", customers)
+        # AUTOINCREMENT ids are contiguous inside the transaction, so derive them from the last one
+        last_id = cur.execute("SELECT last_insert_rowid()").fetchone()[0]
+        start = last_id - len(customers) + 1
         # add loan with upcoming due date
-        execute("INSERT INTO loans (customer_id, emi_amount, due_date) VALUES (?, ?, ?)",
-                (cid, 4000, (date.today()).isoformat()))
+        due = date.today().isoformat()
+        cur.executemany("INSERT INTO loans (customer_id, emi_amount, due_date) VALUES (?, ?, ?)",
+                        [(cid, 4000, due) for cid in range(start, start + len(customers))])
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    clear_read_cache()
     return "Seeded demo customers and loans."
 
 # --- Utility: language messages ---
@@ -108,71 +270,131 @@ LANG_MSGS = {
     "hi": {
         "reminder": "नमस्ते {name}. यह TVS क्रेडिट से रिमाइंडर है। आपकी अगली EMI {amount} रुपये है। भुगतान के लिए 1 दबाएँ, पुनर्निर्धारण के लिए 2 दबाएँ.",
         "link_sent": "हमने आपके नंबर पर भुगतान लिंक भेज दिया है। धन्यवाद।",
-        "rescheduled": "आपका अनुरोध नोट कर लिया गया है। एक एजेंट आपको एक नई तारीख की पुष्टि करने के लिए जल्द ही कॉल करेगा। धन्यवाद।"
+        "rescheduled": "आपका अनुरोध नोट कर लिया गया है। एक एजेंट आपको एक नई तारीख की पुष्टि करने के लिए जल्द ही कॉल करेगा। धन्यवाद।",
+        "sms_body": "TVS क्रेडिट: अपनी {amount} रुपये की EMI का भुगतान करें। भुगतान के लिए क्लिक करें {link}"
     },
     "en": {
         "reminder": "Hello {name}. This is a reminder from TVS Credit. Your EMI of Rs {amount} is due. Press 1 to pay now, or press 2 to request a reschedule.",
         "link_sent": "We have sent a payment link to your phone. Thank you.",
-        "rescheduled": "Your request has been noted. An agent will call you back shortly to confirm a new date. Thank you."
+        "rescheduled": "Your request has been noted. An agent will call you back shortly to confirm a new date. Thank you.",
+        "sms_body": "TVS Credit: Pay your EMI of Rs {amount}. Click {link}"
     },
     "ta": {
         "reminder": "வணக்கம் {name}. இது TVS Credit நினைவூட்டலாகும். உங்கள் EMI {amount} ரூபாய் நிலுவையில் உள்ளது. இப்போது செலுத்த 1 ஐ அழுத்தவும், மாற்றம் செய்ய 2 ஐ அழுத்தவும்.",
         "link_sent": "உங்கள் எண்ணுக்கான கட்டண இணைப்பு அனுப்பப்பட்டுள்ளது.",
-        "rescheduled": "உங்கள் கோரிக்கை ஏற்கப்பட்டது. ஒரு முகவர் புதிய தேதியை உறுதிப்படுத்த உங்களை மீண்டும் அழைப்பார். நன்றி."
+        "rescheduled": "உங்கள் கோரிக்கை ஏற்கப்பட்டது. ஒரு முகவர் புதிய தேதியை உறுதிப்படுத்த உங்களை மீண்டும் அழைப்பார். நன்றி.",
+        "sms_body": "TVS Credit: உங்கள் EMI {amount} ரூபாயை செலுத்துங்கள். கிளிக் செய்யவும் {link}"
     },
     "bn": {
         "reminder": "নমস্কার {name}. এটি TVS Credit থেকে একটি রিমাইন্ডার। আপনার EMI {amount} টাকা বাকি আছে। পে করতে 1 চেপে দিন, পুনঃনির্ধারণ করতে 2 চেপে দিন।",
         "link_sent": "পেমেন্ট লিঙ্ক আপনার ফোনে পাঠানো হয়েছে। ধন্যবাদ।",
-        "rescheduled": "আপনার অনুরোধ নোট করা হয়েছে। একজন এজেন্ট একটি নতুন তারিখ নিশ্চিত করতে আপনাকে শীঘ্রই আবার কল করবে। ধন্যবাদ।"
+        "rescheduled": "আপনার অনুরোধ নোট করা হয়েছে। একজন এজেন্ট একটি নতুন তারিখ নিশ্চিত করতে আপনাকে শীঘ্রই আবার কল করবে। ধন্যবাদ।",
+        "sms_body": "TVS Credit: আপনার {amount} টাকার EMI পরিশোধ করুন। ক্লিক করুন {link}"
     }
 }
 
+# Fallback mapping; formatted messages are memoized since bulk calls repeat the same inputs
+@functools.lru_cache(maxsize=2048)
+def _format_msg(lang, key, fields):
+    templates = LANG_MSGS.get(lang, LANG_MSGS["en"])
+    return templates[key].format(**dict(fields))
+
 def get_msg(lang, key, **kwargs):
-    return LANG_MSGS.get(lang, LANG_MSGS["en"])[key].format(**kwargs)
+    return _format_msg(lang, key, tuple(sorted(kwargs.items())))
+
+# --- Background Twilio dispatch ---
+# Twilio HTTPS round-trips run on a small worker pool so the Streamlit rerun isn't blocked and
+# bulk sends overlap (the rate limiter caps QPS). For production, swap this pool for RQ/Redis.
+TWILIO_WORKERS = 10
+
+def _run_task(fn, *args):
+    try:
+        fn(*args)
+    except Exception as e:
+        # e.g. "database is locked" on the log write; log it rather than lose it in the future
+        _log_task_failure(fn, args, e)
+
+@st.cache_resource
+def get_task_pool():
+    """Start the Twilio worker pool once per process."""
+    return ThreadPoolExecutor(max_workers=TWILIO_WORKERS, thread_name_prefix="twilio")
+
+def _status_callback(loan_id):
+    """Extra create() kwargs registering the status webhook, tagged with the loan id."""
+    if not TWILIO_STATUS_CALLBACK_URL:
+        return {}
+    sep = "&" if "?" in TWILIO_STATUS_CALLBACK_URL else "?"
+    return {"status_callback": f"{TWILIO_STATUS_CALLBACK_URL}{sep}loan_id={loan_id}"}
+
+def _do_twilio_call(phone, twiml, loan_id):
+    wait_for_dispatch_slot(phone)
+    try:
+        call = tw_client.calls.create(to=phone, from_=TWILIO_NUMBER, twiml=twiml, **_status_callback(loan_id))
+    except Exception as e:
+        execute(SQL_LOG_INSERT, (loan_id, "call_failed", f"to {phone} | {e}"))
+        return
+    execute(SQL_LOG_INSERT, (loan_id, "twilio_call", f"to {phone} | {call.sid}"))
+
+def _do_twilio_sms(phone, body, loan_id):
+    wait_for_dispatch_slot(phone)
+    try:
+        msg = tw_client.messages.create(body=body, from_=TWILIO_NUMBER, to=phone, **_status_callback(loan_id))
+    except Exception as e:
+        execute(SQL_LOG_INSERT, (loan_id, "payment_link_failed", str(e)))
+        return
+    execute(SQL_LOG_INSERT, (loan_id, "payment_link_sent", f"tw_sms:{msg.sid}"))
+
+# Failure event per task; every task takes loan_id as its last argument
+_TASK_FAIL_EVENTS = {_do_twilio_call: "call_failed", _do_twilio_sms: "payment_link_failed"}
+
+def _log_task_failure(fn, args, e):
+    try:
+        execute(SQL_LOG_INSERT, (args[-1], _TASK_FAIL_EVENTS.get(fn, "task_failed"), f"worker error: {e}"))
+    except Exception:
+        pass  # the DB itself is failing; dropping this row beats losing the task silently
 
 # --- Core functions ---
 def place_call(loan_id):
     """Place a call (real Twilio or mock) to the loan's customer"""
-    loan = query_all("SELECT l.id, l.emi_amount, c.name, c.phone, c.language FROM loans l JOIN customers c ON l.customer_id = c.id WHERE l.id = ?", (loan_id,))
+    loan = query_all(SQL_LOAN_CONTACT, (loan_id,))
     if not loan:
         return {"error": "Loan not found"}
     
     loan_info = loan[0]
     text = get_msg(loan_info['language'], "reminder", name=loan_info['name'], amount=loan_info['emi_amount'])
-    execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "call_initiated", f"to {loan_info['phone']}"))
-
+    # One log row per call, written once the outcome is known
     if USE_TWILIO and tw_client:
         # NEW: Using <Gather> to simulate an interactive menu
-        twiml = f"<Response><Gather input='dtmf' timeout='5' numDigits='1'><Say language='en-IN'>{text}</Say></Gather></Response>"
-        call = tw_client.calls.create(to=loan_info['phone'], from_=TWILIO_NUMBER, twiml=twiml)
-        execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "twilio_call", call.sid))
-        return {"status": "twilio_call_placed", "sid": call.sid}
+        twiml = TWIML_TEMPLATE.format(lang=TTS_LANG_MAP.get(loan_info['language'], "en-IN"), text=text)
+        # The pool logs the call sid (or failure) once Twilio responds
+        get_task_pool().submit(_run_task, _do_twilio_call, loan_info['phone'], twiml, loan_id)
+        return {"status": "twilio_call_pending"}
     else:
-        execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "mock_call", text))
+        execute(SQL_LOG_INSERT, (loan_id, "mock_call", f"to {loan_info['phone']} | {text}"))
         return {"status": "mock_call_logged", "text": text}
 
 def send_payment_link(loan_id):
     """Generate mock payment link and send via SMS."""
-    loan = query_all("SELECT l.id, l.emi_amount, c.name, c.phone, c.language FROM loans l JOIN customers c ON l.customer_id = c.id WHERE l.id = ?", (loan_id,))
+    loan = query_all(SQL_LOAN_CONTACT, (loan_id,))
     if not loan: return {"error": "Loan not found"}
     
     loan_info = loan[0]
     payment_link = f"https://example.com/pay?loan={loan_id}&amount={loan_info['emi_amount']}"
-    sms_body = f"TVS Credit: Pay your EMI of Rs {loan_info['emi_amount']}. Click {payment_link}"
+    sms_body = get_msg(loan_info['language'], "sms_body", amount=loan_info['emi_amount'], link=payment_link)
     
     if USE_TWILIO and tw_client:
-        msg = tw_client.messages.create(body=sms_body, from_=TWILIO_NUMBER, to=loan_info['phone'])
-        detail = f"tw_sms:{msg.sid}"
-    else:
-        detail = f"mock_sms_sent_to_{loan_info['phone']}::{payment_link}"
-    
-    execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "payment_link_sent", detail))
+        # The pool sends the SMS and logs it once Twilio responds
+        get_task_pool().submit(_run_task, _do_twilio_sms, loan_info['phone'], sms_body, loan_id)
+        return {"status": "payment_link_pending", "link": payment_link}
+
+    detail = f"mock_sms_sent_to_{loan_info['phone']}::{payment_link}"
+    execute(SQL_LOG_INSERT, (loan_id, "payment_link_sent", detail))
     return {"status": "payment_link_sent", "link": payment_link}
 
 def mark_paid(loan_id):
     """Mark a loan as paid. Simulates a payment gateway callback."""
     execute("UPDATE loans SET status = 'paid' WHERE id = ?", (loan_id,))
-    execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "marked_paid", "Webhook/Manual"))
+    execute(SQL_LOG_INSERT, (loan_id, "marked_paid", "Webhook/Manual"))
     return {"status": "ok"}
 
 # NEW: Function to handle rescheduling
@@ -185,7 +407,7 @@ def reschedule_loan(loan_id, days_to_add=7):
     new_due_date = current_due_date + timedelta(days=days_to_add)
     
     execute("UPDATE loans SET status = 'rescheduled', due_date = ? WHERE id = ?", (new_due_date.isoformat(), loan_id))
-    execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "rescheduled", f"New due date: {new_due_date.isoformat()}"))
+    execute(SQL_LOG_INSERT, (loan_id, "rescheduled", f"New due date: {new_due_date.isoformat()}"))
     return {"status": "rescheduled", "new_date": new_due_date.isoformat()}
 
 # --- Streamlit UI ---
@@ -214,8 +436,8 @@ with left:
             emi_amt = st.number_input("EMI Amount (₹)", min_value=100, value=4000, step=100)
             due = st.date_input("Due date", value=date.today())
             if st.form_submit_button("Create Loan"):
-                cid = execute("INSERT INTO customers (name, phone, language) VALUES (?, ?, ?)", (cname, cphone, clang))
-                loan_id = execute("INSERT INTO loans (customer_id, emi_amount, due_date) VALUES (?, ?, ?)", (cid, emi_amt, due.isoformat()))
+                cid = execute_returning("INSERT INTO customers (name, phone, language) VALUES (?, ?, ?)", (cname, cphone, clang))
+                loan_id = execute_returning("INSERT INTO loans (customer_id, emi_amount, due_date) VALUES (?, ?, ?)", (cid, emi_amt, due.isoformat()))
                 st.success(f"Created loan id {loan_id} for {cname}")
                 st.rerun()
 
@@ -229,10 +451,16 @@ with left:
             st.warning("No overdue loans to call.")
         else:
             progress_bar = st.progress(0, text=f"Calling {len(overdue_loans)} customers...")
-            for i, loan in enumerate(overdue_loans):
-                res = place_call(loan['id'])
-                st.toast(f"Called loan {loan['id']}: {res.get('status', 'failed')}")
-                progress_bar.progress((i + 1) / len(overdue_loans), text=f"Calling {i+1}/{len(overdue_loans)}...")
+            # Calls are I/O-bound (Twilio HTTPS), so dispatch them concurrently; each worker
+            # logs on its own connection, and WAL with synchronous=NORMAL keeps those commits cheap.
+            # UI updates stay on this thread as each call completes.
+            with ThreadPoolExecutor(max_workers=10) as ex:
+                futures = {ex.submit(place_call, loan['id']): loan for loan in overdue_loans}
+                for i, fut in enumerate(as_completed(futures)):
+                    loan = futures[fut]
+                    res = fut.result()
+                    st.toast(f"Called loan {loan['id']}: {res.get('status', 'failed')}")
+                    progress_bar.progress((i + 1) / len(overdue_loans), text=f"Calling {i+1}/{len(overdue_loans)}...")
             progress_bar.empty()
             st.success(f"Finished calling all {len(overdue_loans)} overdue customers.")
             st.rerun()
@@ -241,17 +469,17 @@ with left:
     
     # --- Individual Loan Actions ---
     st.header("Individual Loan Actions")
-    all_loans = query_all("SELECT l.id, c.name, l.emi_amount, l.due_date, l.status FROM loans l JOIN customers c ON l.customer_id = c.id ORDER BY l.id DESC")
+    all_loans = fetch_loans()
     
-    if not all_loans:
+    if all_loans.empty:
         st.info("No loans yet. Seed demo or create a loan.")
     else:
         # UPDATED: Selectbox label is more informative
-        loan_map = {f"Loan {r['id']} | {r['name']} | ₹{r['emi_amount']} | Status: {r['status'].upper()}": r['id'] for r in all_loans}
-        sel_label = st.selectbox("Pick a loan to manage", options=list(loan_map.keys()))
-        sel_loan_id = loan_map[sel_label]
+        # Options are the loan ids; labels are only rendered via format_func
+        loan_labels = {r.id: f"Loan {r.id} | {r.name} | ₹{r.emi_amount} | Status: {r.status.upper()}" for r in all_loans.itertuples(index=False)}
+        sel_loan_id = st.selectbox("Pick a loan to manage", options=list(loan_labels), format_func=loan_labels.__getitem__)
         
-        st.write(f"**Selected:** `{sel_label}`")
+        st.write(f"**Selected:** `{loan_labels[sel_loan_id]}`")
 
         action_cols = st.columns(3)
         if action_cols[0].button("Place Voice Call", key=f"call_{sel_loan_id}"):
@@ -268,7 +496,8 @@ with left:
                 res = send_payment_link(sel_loan_id)
                 if "error" in res: st.error(res["error"])
                 else: 
-                    st.success(f"Link sent successfully. URL: {res.get('link')}")
+                    sent = "queued" if res["status"] == "payment_link_pending" else "sent successfully"
+                    st.success(f"Link {sent}. URL: {res.get('link')}")
                     st.rerun()
 
         if action_cols[2].button("Mark as Paid", key=f"paid_{sel_loan_id}"):
@@ -289,13 +518,13 @@ with right:
     st.header("Dashboard & Logs")
 
     # --- Metrics & Chart ---
-    status_counts = query_all("SELECT status, COUNT(*) as count FROM loans GROUP BY status")
-    status_data = {item['status']: item['count'] for item in status_counts}
-    
-    total_loans = sum(status_data.values())
-    paid_loans = status_data.get('paid', 0)
-    rescheduled_loans = status_data.get('rescheduled', 0)
-    overdue_loans = query_all("SELECT COUNT(*) as count FROM loans WHERE due_date <= ? AND status='due'", (date.today().isoformat(),))[0]['count']
+    counts = fetch_counters(date.today().isoformat())
+
+    total_loans = counts['total']
+    paid_loans = counts['paid']
+    rescheduled_loans = counts['resched']
+    overdue_loans = counts['overdue']
+    status_data = {status: counts[key] for status, key in (('paid', 'paid'), ('due', 'due'), ('rescheduled', 'resched')) if counts[key]}
 
     c1, c2, c3, c4 = st.columns(4)
     c1.metric("Total Loans", total_loans)
@@ -317,20 +546,19 @@ with right:
 
     with tab1:
         st.subheader("Loans Table")
-        if all_loans:
-            loans_df = pd.DataFrame(all_loans)[['id', 'name', 'status', 'emi_amount', 'due_date']]
-            st.dataframe(loans_df, use_container_width=True)
+        if not all_loans.empty:
+            st.dataframe(all_loans[['id', 'name', 'status', 'emi_amount', 'due_date']], use_container_width=True)
         else:
             st.info("No loans to display.")
 
     with tab2:
         st.subheader("Recent Call & Payment Logs")
-        logs = query_all("SELECT id, loan_id, event, detail, ts FROM call_logs ORDER BY ts DESC LIMIT 100")
-        if logs:
-            st.dataframe(pd.DataFrame(logs), use_container_width=True)
+        logs_df = fetch_logs()
+        if not logs_df.empty:
+            st.dataframe(logs_df, use_container_width=True)
         else:
             st.info("No logs yet.")
 
 st.write("---")
-st.caption("Notes: Twilio integration is optional. If you set TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, and TWILIO_PHONE_NUMBER in a .env file, the app will attempt to place real calls / send real SMS. Otherwise the app will mock those actions for demo purposes.")
+st.caption("Notes: Twilio integration is optional. If you set TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, and TWILIO_PHONE_NUMBER in a .env file, the app will attempt to place real calls / send real SMS. Otherwise the app will mock those actions for demo purposes. Set TWILIO_STATUS_CALLBACK_URL to have Twilio push delivery status to your webhook.")
 
@@ -1,15 +1,25 @@
 
 # ap.py
+import functools
+import json
+import math
 import os
+import string
 import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
+from xml.sax.saxutils import escape as xml_escape
 from dotenv import load_dotenv
 import streamlit as st
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go 
-import random
 # Optional Twilio (only used if credentials set)
 try:
     from twilio.rest import Client
@@ -27,13 +37,71 @@ if USE_TWILIO:
     tw_client = Client(TWILIO_SID, TWILIO_AUTH)
 else:
     tw_client = None
+# Resolved once so the call/SMS paths don't re-check USE_TWILIO; None means mock mode
+tw_calls = tw_client.calls if tw_client else None
+tw_messages = tw_client.messages if tw_client else None
+
+# Fixed TwiML markup, built once; only the (XML-escaped) message text varies per call
+TWIML_TMPL = string.Template("<Response><Gather input='dtmf' timeout='5' numDigits='1'><Say language='en-IN'>$text</Say></Gather></Response>")
+
+# --- Twilio rate limiting ---
+# Twilio rejects or queues requests above its per-number and per-account QPS limits
+PER_NUMBER_QPS = 1
+ACCOUNT_QPS = 10
+
+class RateLimiter:
+    """Sliding one-second windows of dispatch timestamps, per phone number and per account."""
+
+    def __init__(self, per_number=PER_NUMBER_QPS, account=ACCOUNT_QPS, window=1.0):
+        self.per_number = per_number
+        self.account = account
+        self.window = window
+        self._per_number = defaultdict(deque)
+        self._account = deque()
+        self._lock = threading.Lock()
+
+    def allow(self, phone):
+        """Record a dispatch to `phone` and return True if both limits have room, else False."""
+        now = time.monotonic()
+        cutoff = now - self.window
+        with self._lock:
+            number_q = self._per_number[phone]
+            for q in (number_q, self._account):
+                while q and q[0] <= cutoff:
+                    q.popleft()
+            if len(number_q) >= self.per_number or len(self._account) >= self.account:
+                return False
+            number_q.append(now)
+            self._account.append(now)
+            return True
+
+# Shared across reruns and sessions so the account-wide limit holds for the whole app
+@st.cache_resource
+def get_rate_limiter():
+    return RateLimiter()
+
+def wait_for_dispatch_slot(phone):
+    rl = get_rate_limiter()
+    while not rl.allow(phone):
+        time.sleep(0.05)
 
 DB_PATH = "emi_genie_streamlit.db"
 
 # --- Database helpers ---
 def init_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # Larger prepared-statement cache so every hot statement below stays compiled
+    # isolation_level=None: the driver never opens implicit transactions; each statement
+    # autocommits unless txn() below has an explicit BEGIN open
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
+    # Rows index by column name without building a dict per row
+    conn.row_factory = sqlite3.Row
     cur = conn.cursor()
+    # WAL + relaxed fsync: readers don't block the writer and each commit is far cheaper
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA cache_size=-20000")
     cur.execute("""
     CREATE TABLE IF NOT EXISTS customers (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -60,24 +128,165 @@ def init_db():
         ts DATETIME DEFAULT CURRENT_TIMESTAMP
     )
     """)
-    conn.commit()
+    # Indexes for the loan picker's ORDER BY and per-loan log lookups
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_loans_due_date ON loans(due_date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_call_logs_loan ON call_logs(loan_id)")
+    # Covers the dashboard's per-event MIN(ts) GROUP BY loan_id without touching the table
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_call_logs_event_loan_ts ON call_logs(event, loan_id, ts)")
+    # Integer day number of due_date (SQLite >= 3.31 generated column) plus a partial index over
+    # open loans only, so the bulk-call targeting is a range seek on a small index.
+    # table_xinfo (not table_info) lists generated columns; ALTER only when it's missing.
+    if "due_date_day" not in {r[1] for r in cur.execute("PRAGMA table_xinfo(loans)")}:
+        cur.execute("ALTER TABLE loans ADD COLUMN due_date_day INTEGER GENERATED ALWAYS AS (CAST(julianday(due_date) AS INTEGER)) VIRTUAL")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_due_open ON loans(due_date_day) WHERE status = 'due'")
+    # Superseded by idx_due_open; dropped so the planner doesn't pick it for the overdue range
+    cur.execute("DROP INDEX IF EXISTS idx_loans_status_due")
+    # The status-log trigger from earlier versions fired for every app sharing this DB file (ap2
+    # logs its own rows, so they were doubled); mark_paid/reschedule_loan now log in their txn()
+    cur.execute("DROP TRIGGER IF EXISTS trg_loan_status_log")
+    # Pre-joined loans + customers for the dashboard, kept in step by triggers so each rerun reads
+    # one table instead of re-running the join. loans/customers remain the source of truth.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS loans_dash (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        status TEXT,
+        emi_amount INTEGER,
+        due_date TEXT,
+        language TEXT
+    )
+    """)
+    for event in ("INSERT", "UPDATE"):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_loans_dash_{event.lower()}
+        AFTER {event} ON loans
+        BEGIN
+            INSERT OR REPLACE INTO loans_dash (id, name, status, emi_amount, due_date, language)
+            SELECT NEW.id, c.name, NEW.status, NEW.emi_amount, NEW.due_date, c.language
+            FROM customers c WHERE c.id = NEW.customer_id;
+        END
+        """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_loans_dash_delete
+    AFTER DELETE ON loans
+    BEGIN
+        DELETE FROM loans_dash WHERE id = OLD.id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_loans_dash_customer
+    AFTER UPDATE OF name, language ON customers
+    BEGIN
+        UPDATE loans_dash SET name = NEW.name, language = NEW.language
+        WHERE id IN (SELECT id FROM loans WHERE customer_id = NEW.id);
+    END
+    """)
+    # Backfill databases created before loans_dash existed
+    if cur.execute("SELECT (SELECT COUNT(*) FROM loans) != (SELECT COUNT(*) FROM loans_dash)").fetchone()[0]:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("DELETE FROM loans_dash")
+        cur.execute("""
+        INSERT INTO loans_dash (id, name, status, emi_amount, due_date, language)
+        SELECT l.id, c.name, l.status, l.emi_amount, l.due_date, c.language
+        FROM loans l JOIN customers c ON l.customer_id = c.id
+        """)
+        cur.execute("COMMIT")
     return conn
 
-conn = init_db()
+# Streamlit re-executes this module on every interaction, so the connection and its lock are
+# process-wide resources: opened (and the schema checked) once, shared by all sessions and reruns
+@st.cache_resource
+def get_conn():
+    return init_db()
+
+@st.cache_resource
+def get_db_lock():
+    # The connection is shared across threads; SQLite allows one writer at a time anyway
+    return threading.Lock()
+
+conn = get_conn()
+_db_lock = get_db_lock()
 
 def query_all(q, args=()):
-    cur = conn.cursor()
-    cur.execute(q, args)
-    columns = [description[0] for description in cur.description]
-    rows = [dict(zip(columns, row)) for row in cur.fetchall()]
-    return rows
+    with _db_lock:
+        cur = conn.cursor()
+        cur.execute(q, args)
+        return cur.fetchall()
+
+def query_col(q, args=()):
+    """First column of every result row, as a plain list."""
+    with _db_lock:
+        return [r[0] for r in conn.execute(q, args)]
+
+def query_df(q, args=(), **kwargs):
+    """Result set as a typed DataFrame; kwargs go to pd.read_sql_query (e.g. parse_dates)."""
+    with _db_lock:
+        return pd.read_sql_query(q, conn, params=args, **kwargs)
 
 def execute(q, args=()):
-    cur = conn.cursor()
-    cur.execute(q, args)
-    conn.commit()
+    # Autocommit connection: a lone statement commits itself, no conn.commit() needed
+    with _db_lock:
+        cur = conn.cursor()
+        cur.execute(q, args)
+    clear_read_cache()
     return cur.lastrowid
 
+@contextmanager
+def txn():
+    """Hold the connection for one BEGIN IMMEDIATE ... COMMIT; roll back if the block raises."""
+    with _db_lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+# UPDATE ... RETURNING needs SQLite >= 3.35; older builds (e.g. Debian bullseye's 3.34) re-select instead
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Hot-path statements: passing the identical SQL string keeps sqlite3's statement cache hitting
+SQL_LOG_INSERT = "INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)"
+SQL_CUSTOMER_INSERT = "INSERT INTO customers (name, phone, language) VALUES (?, ?, ?)"
+SQL_LOAN_INSERT = "INSERT INTO loans (customer_id, emi_amount, due_date, status) VALUES (?, ?, ?, ?)"
+LOAN_CALL_SELECT = "SELECT l.id, l.emi_amount, l.due_date, c.name, c.phone, c.language FROM loans l JOIN customers c ON l.customer_id = c.id"
+# Bulk targets filter on due_date_day so idx_due_open serves them; the bound ISO date is
+# converted the same way the generated column is
+SQL_PRE_DUE_TARGETS = f"{LOAN_CALL_SELECT} WHERE l.status = 'due' AND l.due_date_day = CAST(julianday(?) AS INTEGER)"
+SQL_OVERDUE_TARGETS = f"{LOAN_CALL_SELECT} WHERE l.status = 'due' AND l.due_date_day <= CAST(julianday(?) AS INTEGER)"
+
+# One row per called loan: its first call and (LEFT JOIN) first payment. Both subqueries
+# are served from idx_call_logs_event_loan_ts in GROUP BY order.
+SQL_FIRST_CALL_PAID = """
+    SELECT c.loan_id, c.t_call, p.t_paid
+    FROM (SELECT loan_id, MIN(ts) AS t_call FROM call_logs WHERE event = 'call_initiated' GROUP BY loan_id) c
+    LEFT JOIN (SELECT loan_id, MIN(ts) AS t_paid FROM call_logs WHERE event = 'marked_paid' GROUP BY loan_id) p
+        ON p.loan_id = c.loan_id
+"""
+
+# --- Cached reads (Streamlit reruns the whole script on every interaction) ---
+def loans_version():
+    """Cheap change token for the loans table; status/date edits also clear the cache explicitly."""
+    return tuple(query_all("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM loans")[0])
+
+@st.cache_data(show_spinner=False)
+def load_loan_labels(version):
+    """Loan picker labels -> loan id, built from only the columns the label shows."""
+    with _db_lock:
+        rows = conn.execute("SELECT l.id, c.name, l.status, l.due_date FROM loans l JOIN customers c ON l.customer_id = c.id ORDER BY l.due_date ASC").fetchall()
+    return {f"Loan {i} | {n} | Status: {s.upper()} | Due: {d}": i for i, n, s, d in rows}
+
+# Dashboard queries, keyed on SQL + params (so each filter selection gets its own entry).
+# Writes clear these; the TTL is only a backstop for changes made outside this app.
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_df(q, args=(), **kwargs):
+    return query_df(q, args, **kwargs)
+
+def clear_read_cache():
+    load_loan_labels.clear()
+    cached_df.clear()
+
 # --- Seed demo data ---
 def seed_demo():
     """
@@ -85,7 +294,7 @@ def seed_demo():
     This new version creates more data with randomized statuses and due dates
     to provide a richer demonstration.
     """
-    existing = query_all("SELECT COUNT(*) as count FROM customers")[0]['count']
+    existing = query_col("SELECT COUNT(*) FROM customers")[0]
     if existing > 0:
         return f"Database already contains {existing} customers. To re-seed, please delete the 'emi_genie_streamlit.db' file and restart."
 
@@ -105,32 +314,40 @@ def seed_demo():
         ("John Smith", "+447123456789", "en")         # English
     ]
     
-    total_loans_created = 0
     today = date.today()
-
-    for name, phone, lang in customers_to_seed:
-        cid = execute("INSERT INTO customers (name, phone, language) VALUES (?, ?, ?)", (name, phone, lang))
-        
-        # Create 1 or 2 loans for each customer for variety
-        for _ in range(random.randint(1, 2)):
-            # Randomly assign a status to make the dashboard more interesting
-            status = random.choices(["due", "paid", "rescheduled"], weights=[0.7, 0.2, 0.1], k=1)[0]
-            emi = random.randint(15, 80) * 100 # EMI between 1500 and 8000
-
-            if status == "paid":
-                # Paid loans should have a due date in the past
-                due_dt = today - timedelta(days=random.randint(15, 60))
-            elif status == "rescheduled":
-                # Rescheduled loans should have a due date in the future
-                due_dt = today + timedelta(days=random.randint(10, 25))
-            else: # status is 'due'
-                # 'Due' loans can be overdue, due soon, or due in the future
-                # This creates targets for both "Overdue" and "Pre-Due" calls
-                due_dt = today + timedelta(days=random.randint(-10, 20))
-
-            execute("INSERT INTO loans (customer_id, emi_amount, due_date, status) VALUES (?, ?, ?, ?)",
-                    (cid, emi, due_dt.isoformat(), status))
-            total_loans_created += 1
+    n = len(customers_to_seed)
+    rng = np.random.default_rng()
+
+    # Draw every loan attribute as one array instead of sampling per loan
+    # Create 1 or 2 loans for each customer for variety
+    loans_per_customer = rng.integers(1, 3, size=n)
+    m = int(loans_per_customer.sum())
+    # Randomly assign a status to make the dashboard more interesting
+    statuses = rng.choice(["due", "paid", "rescheduled"], size=m, p=[0.7, 0.2, 0.1])
+    emis = rng.integers(15, 81, size=m) * 100 # EMI between 1500 and 8000
+    # Paid loans fall 15-60 days in the past, rescheduled ones 10-25 days ahead; 'due' loans span
+    # -10..+20 days so there are targets for both "Overdue" and "Pre-Due" calls
+    offsets = np.select(
+        [statuses == "paid", statuses == "rescheduled"],
+        [-rng.integers(15, 61, size=m), rng.integers(10, 26, size=m)],
+        default=rng.integers(-10, 21, size=m),
+    )
+    due_dates = [(today + timedelta(days=o)).isoformat() for o in offsets.tolist()]
+
+    # Insert everything in one transaction so the seed costs a single commit
+    with txn():
+        cur = conn.cursor()
+        cur.executemany(SQL_CUSTOMER_INSERT, customers_to_seed)
+        # AUTOINCREMENT ids are contiguous inside the transaction, so derive them from the last one
+        last_id = cur.execute("SELECT last_insert_rowid()").fetchone()[0]
+        start = last_id - n + 1
+        cids = np.repeat(np.arange(start, start + n), loans_per_customer)
+
+        # .tolist() hands sqlite3 plain Python ints/strs rather than NumPy scalars
+        loans_to_seed = list(zip(cids.tolist(), emis.tolist(), due_dates, statuses.tolist()))
+        cur.executemany(SQL_LOAN_INSERT, loans_to_seed)
+    clear_read_cache()
+    total_loans_created = len(loans_to_seed)
 
     return f"✅ Seeded {len(customers_to_seed)} new customers and {total_loans_created} loans with varied statuses and due dates."
 
@@ -309,30 +526,109 @@ LANG_MSGS = {
     }
 }
 
+class SafeDict(dict):
+    """format_map fields that render any placeholder not supplied as an empty string."""
+    def __missing__(self, key):
+        return ""
+
+# Flat lookup table built once at import: slot lang_idx * len(MSG_KEYS) + key_idx holds that
+# template's bound format_map. English (index 0) covers unknown languages and missing keys.
+MSG_KEYS = ("reminder", "pre_due_reminder", "link_sent", "rescheduled")
+KEY_IDX = {k: i for i, k in enumerate(MSG_KEYS)}
+LANG_IDX = {lang: i for i, lang in enumerate(LANG_MSGS)}
+TEMPLATES = tuple(msgs.get(k, LANG_MSGS["en"][k]).format_map for msgs in LANG_MSGS.values() for k in MSG_KEYS)
+
 def get_msg(lang, key, **kwargs):
-    return LANG_MSGS.get(lang, LANG_MSGS["en"])[key].format(**kwargs)
+    return TEMPLATES[LANG_IDX.get(lang, 0) * len(MSG_KEYS) + KEY_IDX[key]](SafeDict(kwargs))
 
 # --- Core functions ---
+
+def fetch_loans_by_ids(ids):
+    """Fetch loan + customer fields for many loans in one query."""
+    ids = list(ids)
+    if not ids:
+        return []
+    placeholders = ",".join("?" * len(ids))
+    return query_all(f"{LOAN_CALL_SELECT} WHERE l.id IN ({placeholders})", ids)
+
+def log_events(rows):
+    """Insert (loan_id, event, detail) rows into call_logs in a single transaction."""
+    with txn():
+        conn.executemany(SQL_LOG_INSERT, rows)
+    clear_read_cache()
+
+@functools.lru_cache(maxsize=512)
+def _fmt_due(iso):
+    """'2025-08-15' -> 'August 15, 2025'; bulk runs repeat the same few dates."""
+    return datetime.fromisoformat(iso).strftime('%B %d, %Y')
+
+def build_call_payload(loan_info, message_key="reminder"):
+    """Build the call text for a prefetched loan row (no side effects)."""
+    fields = {"name": loan_info['name'], "amount": loan_info['emi_amount']}
+    # Only the pre-due message mentions the date, so skip the parse/strftime otherwise
+    if message_key == "pre_due_reminder":
+        fields["due_date"] = _fmt_due(loan_info['due_date'])
+    text = get_msg(loan_info['language'], message_key, **fields)
+    return {"loan_id": loan_info['id'], "phone": loan_info['phone'], "text": text}
+
+def dispatch_call(payload):
+    """Place the call (real Twilio or mock); returns (result, call_logs row to insert).
+
+    One "call_initiated" row per call; its JSON detail records the channel plus the sid or text.
+    """
+    loan_id, phone, text = payload["loan_id"], payload["phone"], payload["text"]
+
+    if tw_calls:
+        wait_for_dispatch_slot(phone)
+        twiml = TWIML_TMPL.substitute(text=xml_escape(text))
+        call = tw_calls.create(to=phone, from_=TWILIO_NUMBER, twiml=twiml)
+        detail = {"to": phone, "channel": "twilio", "sid": call.sid}
+        res = {"status": "twilio_call_placed", "sid": call.sid}
+    else:
+        detail = {"to": phone, "channel": "mock", "text": text}
+        res = {"status": "mock_call_logged", "text": text}
+    return res, (loan_id, "call_initiated", json.dumps(detail, ensure_ascii=False))
+
 def place_call(loan_id, message_key="reminder"):
     """Place a call (real Twilio or mock) to the loan's customer."""
-    loan = query_all("SELECT l.id, l.emi_amount, l.due_date, c.name, c.phone, c.language FROM loans l JOIN customers c ON l.customer_id = c.id WHERE l.id = ?", (loan_id,))
+    loan = fetch_loans_by_ids([loan_id])
     if not loan: return {"error": "Loan not found"}
-    
-    loan_info = loan[0]
-    # Format due_date for display
-    formatted_due_date = datetime.fromisoformat(loan_info['due_date']).strftime('%B %d, %Y')
-    
-    text = get_msg(loan_info['language'], message_key, name=loan_info['name'], amount=loan_info['emi_amount'], due_date=formatted_due_date)
-    execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "call_initiated", f"to {loan_info['phone']}"))
-
-    if USE_TWILIO and tw_client:
-        twiml = f"<Response><Gather input='dtmf' timeout='5' numDigits='1'><Say language='en-IN'>{text}</Say></Gather></Response>"
-        call = tw_client.calls.create(to=loan_info['phone'], from_=TWILIO_NUMBER, twiml=twiml)
-        execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "twilio_call", call.sid))
-        return {"status": "twilio_call_placed", "sid": call.sid}
-    else:
-        execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "mock_call", text))
-        return {"status": "mock_call_logged", "text": text}
+
+    res, log_row = dispatch_call(build_call_payload(loan[0], message_key))
+    log_events([log_row])
+    return res
+
+def bulk_call(loans, message_key="reminder", on_progress=None):
+    """Call every prefetched loan row concurrently, then write all call logs in one transaction.
+
+    A failed dispatch is logged as "call_failed" and doesn't stop the rest; returns the failure count.
+    """
+    logs = []
+    failed = 0
+    try:
+        # Calls are I/O-bound (Twilio HTTPS), so run them on a pool; the rate limiter caps
+        # Twilio QPS. Logs and on_progress (UI) stay on this thread as each call completes.
+        with ThreadPoolExecutor(max_workers=10) as ex:
+            futures = {ex.submit(dispatch_call, build_call_payload(loan_info, message_key)): loan_info
+                       for loan_info in loans}
+            # Each progress update is a browser round trip, so report at most ~50 times per run
+            step = max(1, len(futures) // 50)
+            for i, fut in enumerate(as_completed(futures)):
+                try:
+                    _, log_row = fut.result()
+                except Exception as e:
+                    loan_info = futures[fut]
+                    failed += 1
+                    log_row = (loan_info['id'], "call_failed",
+                               json.dumps({"to": loan_info['phone'], "error": str(e)}, ensure_ascii=False))
+                logs.append(log_row)
+                done = i + 1
+                if on_progress and (done % step == 0 or done == len(futures)):
+                    on_progress(done)
+    finally:
+        # Persist logs for the calls that went out even if the UI callback raised
+        log_events(logs)
+    return failed
 
 def send_payment_link(loan_id):
     """Generate mock payment link and send via SMS."""
@@ -343,32 +639,42 @@ def send_payment_link(loan_id):
     payment_link = f"https://example.com/pay?loan={loan_id}&amount={loan_info['emi_amount']}"
     sms_body = f"TVS Credit: Pay your EMI of Rs {loan_info['emi_amount']}. Click {payment_link}"
     
-    if USE_TWILIO and tw_client:
-        msg = tw_client.messages.create(body=sms_body, from_=TWILIO_NUMBER, to=loan_info['phone'])
+    if tw_messages:
+        msg = tw_messages.create(body=sms_body, from_=TWILIO_NUMBER, to=loan_info['phone'])
         detail = f"tw_sms:{msg.sid}"
     else:
         detail = f"mock_sms_sent_to_{loan_info['phone']}::{payment_link}"
     
-    execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "payment_link_sent", detail))
+    execute(SQL_LOG_INSERT, (loan_id, "payment_link_sent", detail))
     return {"status": "payment_link_sent", "link": payment_link}
 
 def mark_paid(loan_id):
-    """Mark a loan as paid."""
-    execute("UPDATE loans SET status = 'paid' WHERE id = ?", (loan_id,))
-    execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "marked_paid", "Webhook/Manual"))
+    """Mark a loan as paid and log it in the same transaction (no log if it was already paid)."""
+    with txn():
+        cur = conn.execute("UPDATE loans SET status = 'paid' WHERE id = ? AND status IS NOT 'paid'", (loan_id,))
+        if cur.rowcount:
+            conn.execute(SQL_LOG_INSERT, (loan_id, "marked_paid", "Webhook/Manual"))
+    clear_read_cache()
     return {"status": "ok"}
 
 def reschedule_loan(loan_id, days_to_add=7):
-    """Reschedule a loan by updating its due date and status."""
-    loan = query_all("SELECT due_date FROM loans WHERE id = ?", (loan_id,))
+    """Reschedule a loan by updating its due date and status, logging it in the same transaction."""
+    # Date arithmetic happens in SQLite, so this is one statement in one transaction
+    sql = "UPDATE loans SET status = 'rescheduled', due_date = date(due_date, ?) WHERE id = ?"
+    args = (f"+{days_to_add} days", loan_id)
+    with txn():
+        if HAS_RETURNING:
+            # fetchall() steps RETURNING to completion so COMMIT has no statement in progress
+            loan = next(iter(conn.execute(sql + " RETURNING due_date", args).fetchall()), None)
+        else:
+            cur = conn.execute(sql, args)
+            loan = conn.execute("SELECT due_date FROM loans WHERE id = ?", (loan_id,)).fetchone() if cur.rowcount else None
+        if loan:
+            conn.execute(SQL_LOG_INSERT, (loan_id, "rescheduled", f"New due date: {loan[0]}"))
+    clear_read_cache()
     if not loan: return {"error": "Loan not found"}
 
-    current_due_date = datetime.fromisoformat(loan[0]['due_date']).date()
-    new_due_date = current_due_date + timedelta(days=days_to_add)
-    
-    execute("UPDATE loans SET status = 'rescheduled', due_date = ? WHERE id = ?", (new_due_date.isoformat(), loan_id))
-    execute("INSERT INTO call_logs (loan_id, event, detail) VALUES (?, ?, ?)", (loan_id, "rescheduled", f"New due date: {new_due_date.isoformat()}"))
-    return {"status": "rescheduled", "new_date": new_due_date.isoformat()}
+    return {"status": "rescheduled", "new_date": loan[0]}
 
 # --- Streamlit UI ---
 st.set_page_config(page_title="TVS Credit", layout="wide", page_icon="🤖")
@@ -391,6 +697,44 @@ st.markdown("""
     </h2>
     """, unsafe_allow_html=True)
 
+# --- Individual Loan Actions ---
+# A fragment: picking a loan or pressing an action reruns only this panel, not the whole page
+# (templates, bulk controls and the dashboard stay as rendered until the next full rerun).
+@st.fragment
+def loan_actions_panel():
+    st.header("Individual Loan Actions")
+    loan_map = load_loan_labels(loans_version())
+
+    if not loan_map:
+        st.info("No loans yet. Seed demo or create a loan.")
+    else:
+        sel_label = st.selectbox("Pick a loan to manage", options=list(loan_map.keys()))
+        sel_loan_id = loan_map[sel_label]
+
+        st.write(f"**Selected:** `{sel_label}`")
+
+        action_cols = st.columns(3)
+        if action_cols[0].button("Place Voice Call", key=f"call_{sel_loan_id}"):
+            with st.spinner("Placing call..."):
+                res = place_call(sel_loan_id)
+                st.success(f"Call Action Status: `{res.get('status')}`")
+                if res.get("text"): st.code(res.get("text"), language="text")
+
+        if action_cols[1].button("Send Payment SMS", key=f"sms_{sel_loan_id}"):
+            with st.spinner("Sending SMS..."):
+                res = send_payment_link(sel_loan_id)
+                st.success(f"Link sent successfully. URL: {res.get('link')}")
+
+        if action_cols[2].button("Mark as Paid", key=f"paid_{sel_loan_id}"):
+            mark_paid(sel_loan_id)
+            st.success(f"Loan {sel_loan_id} marked as PAID.")
+            st.rerun(scope="fragment")
+
+        if st.button("🗓️ Reschedule (+7 Days)", key=f"reschedule_{sel_loan_id}"):
+            res = reschedule_loan(sel_loan_id)
+            st.success(f"Loan {sel_loan_id} rescheduled. New due date: {res['new_date']}")
+            st.rerun(scope="fragment")
+
 left, right = st.columns([2, 3])
 
 # --- Left Panel: Controls & Actions ---
@@ -410,8 +754,8 @@ with left:
             emi_amt = st.number_input("EMI Amount (₹)", min_value=100, value=4000, step=100)
             due = st.date_input("Due date", value=date.today() + timedelta(days=3))
             if st.form_submit_button("Create Loan"):
-                cid = execute("INSERT INTO customers (name, phone, language) VALUES (?, ?, ?)", (cname, cphone, clang))
-                loan_id = execute("INSERT INTO loans (customer_id, emi_amount, due_date) VALUES (?, ?, ?)", (cid, emi_amt, due.isoformat()))
+                cid = execute(SQL_CUSTOMER_INSERT, (cname, cphone, clang))
+                loan_id = execute(SQL_LOAN_INSERT, (cid, emi_amt, due.isoformat(), "due"))
                 st.success(f"Created loan id {loan_id} for {cname}")
                 st.rerun()
 
@@ -425,68 +769,41 @@ with left:
     with b_cols[0]:
         if st.button("📞 Call Pre-Due Customers"):
             pre_due_date = (date.today() + timedelta(days=3)).isoformat()
-            target_loans = query_all("SELECT id FROM loans WHERE due_date = ? AND status='due'", (pre_due_date,))
+            target_loans = query_all(SQL_PRE_DUE_TARGETS, (pre_due_date,))
             if not target_loans:
                 st.warning("No customers with EMIs due in 3 days.")
             else:
                 progress_bar = st.progress(0, text=f"Calling {len(target_loans)} pre-due customers...")
-                for i, loan in enumerate(target_loans):
-                    place_call(loan['id'], message_key="pre_due_reminder")
-                    st.toast(f"Called loan {loan['id']} (pre-due reminder)")
-                    progress_bar.progress((i + 1) / len(target_loans), text=f"Calling {i+1}/{len(target_loans)}...")
+                def on_progress(done):
+                    progress_bar.progress(done / len(target_loans), text=f"Calling {done}/{len(target_loans)}...")
+                failed = bulk_call(target_loans, message_key="pre_due_reminder", on_progress=on_progress)
                 progress_bar.empty()
-                st.success(f"Finished calling all {len(target_loans)} pre-due customers.")
+                st.toast(f"Called {len(target_loans) - failed} loans (pre-due reminder)")
+                if failed:
+                    st.warning(f"{failed} of {len(target_loans)} pre-due calls failed (logged as call_failed).")
+                else:
+                    st.success(f"Finished calling all {len(target_loans)} pre-due customers.")
 
     with b_cols[1]:
         if st.button("🚨 Call Overdue Customers", type="primary"):
-            overdue_loans = query_all("SELECT id FROM loans WHERE due_date <= ? AND status='due'", (date.today().isoformat(),))
+            overdue_loans = query_all(SQL_OVERDUE_TARGETS, (date.today().isoformat(),))
             if not overdue_loans:
                 st.warning("No overdue loans to call.")
             else:
                 progress_bar = st.progress(0, text=f"Calling {len(overdue_loans)} overdue customers...")
-                for i, loan in enumerate(overdue_loans):
-                    place_call(loan['id']) # Default message_key is 'reminder'
-                    st.toast(f"Called loan {loan['id']} (overdue)")
-                    progress_bar.progress((i + 1) / len(overdue_loans), text=f"Calling {i+1}/{len(overdue_loans)}...")
+                def on_progress(done):
+                    progress_bar.progress(done / len(overdue_loans), text=f"Calling {done}/{len(overdue_loans)}...")
+                failed = bulk_call(overdue_loans, on_progress=on_progress) # Default message_key is 'reminder'
                 progress_bar.empty()
-                st.success(f"Finished calling all {len(overdue_loans)} overdue customers.")
+                st.toast(f"Called {len(overdue_loans) - failed} loans (overdue)")
+                if failed:
+                    st.warning(f"{failed} of {len(overdue_loans)} overdue calls failed (logged as call_failed).")
+                else:
+                    st.success(f"Finished calling all {len(overdue_loans)} overdue customers.")
 
     st.write("---")
     
-    # --- Individual Loan Actions ---
-    st.header("Individual Loan Actions")
-    all_loans = query_all("SELECT l.id, c.name, l.emi_amount, l.due_date, l.status FROM loans l JOIN customers c ON l.customer_id = c.id ORDER BY l.due_date ASC")
-    
-    if not all_loans:
-        st.info("No loans yet. Seed demo or create a loan.")
-    else:
-        loan_map = {f"Loan {r['id']} | {r['name']} | Status: {r['status'].upper()} | Due: {r['due_date']}": r['id'] for r in all_loans}
-        sel_label = st.selectbox("Pick a loan to manage", options=list(loan_map.keys()))
-        sel_loan_id = loan_map[sel_label]
-        
-        st.write(f"**Selected:** `{sel_label}`")
-
-        action_cols = st.columns(3)
-        if action_cols[0].button("Place Voice Call", key=f"call_{sel_loan_id}"):
-            with st.spinner("Placing call..."):
-                res = place_call(sel_loan_id)
-                st.success(f"Call Action Status: `{res.get('status')}`")
-                if res.get("text"): st.code(res.get("text"), language="text")
-        
-        if action_cols[1].button("Send Payment SMS", key=f"sms_{sel_loan_id}"):
-            with st.spinner("Sending SMS..."):
-                res = send_payment_link(sel_loan_id)
-                st.success(f"Link sent successfully. URL: {res.get('link')}")
-
-        if action_cols[2].button("Mark as Paid", key=f"paid_{sel_loan_id}"):
-            mark_paid(sel_loan_id)
-            st.success(f"Loan {sel_loan_id} marked as PAID.")
-            st.rerun()
-        
-        if st.button("🗓️ Reschedule (+7 Days)", key=f"reschedule_{sel_loan_id}"):
-            res = reschedule_loan(sel_loan_id)
-            st.success(f"Loan {sel_loan_id} rescheduled. New due date: {res['new_date']}")
-            st.rerun()
+    loan_actions_panel()
 
 # --- Right Panel: Dashboard & Logs ---
 # --- Dashboard Sidebar Filters ---
@@ -494,12 +811,21 @@ with left:
 # --- Dashboard Sidebar Filters ---
 st.sidebar.header("🔍 Dashboard Filters")
 
-# Fetch data once for filter options
-initial_df = pd.DataFrame(query_all("SELECT l.status, c.language FROM loans l JOIN customers c ON l.customer_id = c.id"))
+# Load the dashboard rows once (cached); filter options and filtered data both come from it,
+# so changing a filter re-slices this frame instead of issuing another query.
+# loans_dash is the trigger-maintained loans + customers join (see init_db)
+df = cached_df("""
+    SELECT id, name, status, emi_amount, due_date, language FROM loans_dash
+""", parse_dates=["due_date"])
 
-if not initial_df.empty:
-    status_options = initial_df['status'].unique().tolist()
-    lang_options = initial_df['language'].unique().tolist()
+# Low-cardinality text columns as categoricals: int codes make isin/value_counts/compare cheap
+df['status'] = df['status'].astype('category')
+df['language'] = df['language'].astype('category')
+
+if not df.empty:
+    # astype('category') only creates categories for values present, so these are the options
+    status_options = df['status'].cat.categories.tolist()
+    lang_options = df['language'].cat.categories.tolist()
 
     selected_status = st.sidebar.multiselect("Filter by Status", options=status_options, default=status_options)
     selected_lang = st.sidebar.multiselect("Filter by Language", options=lang_options, default=lang_options)
@@ -510,31 +836,95 @@ else:
     st.sidebar.warning("No data to filter.")
     selected_status, selected_lang, start_date_filter, end_date_filter = [], [], date.today(), date.today()
 
+# --- Dashboard charts ---
+# Shared Plotly styling for the dashboard charts
+_STATUS_COLORS = {'paid': '#2ca02c', 'due': '#ff7f0e', 'rescheduled': '#1f77b4'}
+_PLOTLY_MARGIN = dict(l=20, r=20, t=30, b=20)
+_CHART_HEIGHT = 300
+_BAR_YAXIS = {'categoryorder': 'total ascending', 'title': ''}
+_BAR_XAXIS = {'title': ''}
+
+# Detailed loan table row styling
+STYLE_TODAY = pd.Timestamp(2025, 8, 12)
+ROW_STYLES = (
+    'background-color: #d4edda; color: #155724',  # paid
+    'background-color: #cce5ff; color: #004085',  # rescheduled
+    'background-color: #f8d7da; color: #721c24',  # due, past STYLE_TODAY
+    'background-color: #fff3cd; color: #856404',  # due
+)
+
+# Figures are cached on their (label, count) pairs, so reruns that don't change the counts
+# skip Plotly figure construction; the cached value is the figure dict st.plotly_chart accepts.
+def counts_key(counts):
+    return tuple(zip(counts.index.tolist(), counts.tolist()))
+
+@st.cache_data(show_spinner=False)
+def build_status_pie(counts):
+    status_counts = pd.DataFrame(counts, columns=['status', 'count'])
+    fig_pie = px.pie(status_counts, values='count', names='status', hole=0.4,
+                     color='status',
+                     color_discrete_map=_STATUS_COLORS)
+    fig_pie.update_layout(height=_CHART_HEIGHT, margin=_PLOTLY_MARGIN)
+    return fig_pie.to_dict()
+
+@st.cache_data(show_spinner=False)
+def build_lang_bar(counts):
+    lang_counts = pd.DataFrame(counts, columns=['language', 'count'])
+    fig_bar = px.bar(lang_counts, y='language', x='count', orientation='h', text_auto=True)
+    fig_bar.update_layout(height=_CHART_HEIGHT, margin=_PLOTLY_MARGIN,
+                          yaxis=_BAR_YAXIS, xaxis=_BAR_XAXIS)
+    return fig_bar.to_dict()
+
+def call_effectiveness():
+    """48h conversion rate and average time-to-pay string, or None before any call is logged."""
+    # First call and first payment per called loan, aggregated in SQL (t_paid is NULL if unpaid)
+    first_events = cached_df(SQL_FIRST_CALL_PAID, parse_dates=["t_call", "t_paid"])
+    if first_events.empty:
+        return None
+
+    time_to_pay = first_events['t_paid'] - first_events['t_call']
+
+    # Payments made within 48 hours of a call (NaT never matches)
+    converted = time_to_pay <= pd.Timedelta(hours=48)
+    n_converted = int(converted.sum())
+
+    conversion_rate = (n_converted / len(first_events)) * 100
+    avg_time_to_pay = time_to_pay[converted].mean() if n_converted else pd.Timedelta(0)
+
+    # Readable H:M:S; days fold into hours
+    c = avg_time_to_pay.components
+    return conversion_rate, f"{c.days * 24 + c.hours}h {c.minutes}m {c.seconds}s"
+
+# Rows per page in the detailed loan table
+TABLE_PAGE_SIZE = 50
+
+# Below this many rows, plain boolean masks beat df.query()'s expression-parsing overhead
+QUERY_MIN_ROWS = 10_000
+
 # --- Right Panel: Dashboard & Logs ---
 with right:
     st.header("🚀 Advanced Analytics Dashboard")
     st.markdown(f"_Data as of: {datetime.now().strftime('%B %d, %Y, %I:%M %p')} (IST)_")
 
     # --- Filter Data based on Sidebar ---
-    all_loans_data = query_all("""
-        SELECT l.id, c.name, l.status, l.emi_amount, l.due_date, c.language
-        FROM loans l JOIN customers c ON l.customer_id = c.id
-    """)
-
-    if not all_loans_data:
+    if df.empty:
         st.warning("No loan data available. Please seed the database first.")
     else:
-        df = pd.DataFrame(all_loans_data)
-        df['due_date'] = pd.to_datetime(df['due_date']).dt.date
+        # due_date is datetime64 (parse_dates), so the range checks are int64 comparisons
+        start_ts, end_ts = pd.Timestamp(start_date_filter), pd.Timestamp(end_date_filter)
 
         # Apply filters
-        df_filtered = df[
-            (df['status'].isin(selected_status)) &
-            (df['language'].isin(selected_lang)) &
-            (df['due_date'] >= start_date_filter) &
-            (df['due_date'] <= end_date_filter)
-        ]
-        
+        if len(df) >= QUERY_MIN_ROWS:
+            # One fused expression; pandas evaluates it with numexpr when that's installed
+            df_filtered = df.query("status in @selected_status and language in @selected_lang and @start_ts <= due_date <= @end_ts")
+        else:
+            df_filtered = df[
+                (df['status'].isin(selected_status)) &
+                (df['language'].isin(selected_lang)) &
+                (df['due_date'] >= start_ts) &
+                (df['due_date'] <= end_ts)
+            ]
+
         st.markdown(f"#### Showing **{len(df_filtered)}** of **{len(df)}** total loans")
         st.write("---")
 
@@ -542,33 +932,16 @@ with right:
         with st.container(border=True):
             st.markdown("#### 📞 Call Effectiveness Metrics")
             
-            # Query call and payment logs for analysis
-            call_logs = pd.DataFrame(query_all("SELECT loan_id, ts FROM call_logs WHERE event = 'call_initiated'"))
-            paid_logs = pd.DataFrame(query_all("SELECT loan_id, ts FROM call_logs WHERE event = 'marked_paid'"))
-
-            if not call_logs.empty and not paid_logs.empty:
-                call_logs['ts'] = pd.to_datetime(call_logs['ts'])
-                paid_logs['ts'] = pd.to_datetime(paid_logs['ts'])
-                
-                # Find the first call and first payment for each loan
-                first_calls = call_logs.loc[call_logs.groupby('loan_id')['ts'].idxmin()]
-                first_payments = paid_logs.loc[paid_logs.groupby('loan_id')['ts'].idxmin()]
-
-                # Merge to find time difference
-                merged_logs = pd.merge(first_calls, first_payments, on='loan_id', suffixes=('_call', '_paid'))
-                merged_logs['time_to_pay'] = merged_logs['ts_paid'] - merged_logs['ts_call']
-
-                # Filter for payments made within 48 hours of a call
-                successful_conversions = merged_logs[merged_logs['time_to_pay'] <= timedelta(hours=48)]
-                
-                conversion_rate = (len(successful_conversions) / len(first_calls)) * 100 if not first_calls.empty else 0
-                avg_time_to_pay = successful_conversions['time_to_pay'].mean() if not successful_conversions.empty else timedelta(0)
-                
-                # Convert timedelta to a readable string H:M:S
-                hours, remainder = divmod(avg_time_to_pay.total_seconds(), 3600)
-                minutes, seconds = divmod(remainder, 60)
-                avg_time_str = f"{int(hours)}h {int(minutes)}m {int(seconds)}s"
-
+            # The scalars depend only on call_logs, so recompute them only when it has changed.
+            # call_logs is append-only, so its max rowid is a complete change token (a b-tree seek)
+            eff_fp = query_col("SELECT COALESCE(MAX(id), 0) FROM call_logs")[0]
+            if st.session_state.get('eff_fp') != eff_fp:
+                st.session_state['eff'] = call_effectiveness()
+                st.session_state['eff_fp'] = eff_fp
+            eff = st.session_state['eff']
+
+            if eff:
+                conversion_rate, avg_time_str = eff
                 perf_cols = st.columns(2)
                 perf_cols[0].metric(
                     "Overdue-to-Paid Conversion (48h)",
@@ -589,24 +962,18 @@ with right:
             with st.container(border=True):
                  st.markdown("##### Status Distribution")
                  if not df_filtered.empty:
-                    status_counts = df_filtered['status'].value_counts().reset_index()
-                    fig_pie = px.pie(status_counts, values='count', names='status', hole=0.4,
-                                     color='status',
-                                     color_discrete_map={'paid': '#2ca02c', 'due': '#ff7f0e', 'rescheduled': '#1f77b4'})
-                    fig_pie.update_layout(height=300, margin=dict(l=20, r=20, t=30, b=20))
-                    st.plotly_chart(fig_pie, use_container_width=True)
+                    # Categorical value_counts lists every category; drop the zero rows filtered out
+                    status_counts = df_filtered['status'].value_counts().loc[lambda c: c > 0]
+                    st.plotly_chart(build_status_pie(counts_key(status_counts)), use_container_width=True)
                  else:
                      st.info("No data for the selected filters.")
         with col2:
             with st.container(border=True):
                 st.markdown("##### Loan Distribution by Language")
                 if not df_filtered.empty:
-                    lang_counts = df_filtered['language'].value_counts().nlargest(10).reset_index()
-                    fig_bar = px.bar(lang_counts, y='language', x='count', orientation='h', text_auto=True)
-                    fig_bar.update_layout(height=300, margin=dict(l=20, r=20, t=30, b=20),
-                                          yaxis={'categoryorder':'total ascending', 'title': ''},
-                                          xaxis={'title': ''})
-                    st.plotly_chart(fig_bar, use_container_width=True)
+                    # value_counts already sorts descending, so the top 10 is just the head
+                    lang_counts = df_filtered['language'].value_counts().loc[lambda c: c > 0].head(10)
+                    st.plotly_chart(build_lang_bar(counts_key(lang_counts)), use_container_width=True)
                 else:
                     st.info("No data for the selected filters.")
 
@@ -614,21 +981,25 @@ with right:
         st.markdown("#### 🗂️ Detailed Loan Data (Filtered)")
         
         def style_loan_table(df_to_style):
-            def style_status(row):
-                style = [''] * len(row)
-                today = date(2025, 8, 12)
-                if row.status == 'paid':
-                    style = ['background-color: #d4edda; color: #155724'] * len(row)
-                elif row.status == 'rescheduled':
-                    style = ['background-color: #cce5ff; color: #004085'] * len(row)
-                elif row.status == 'due' and row.due_date < today:
-                     style = ['background-color: #f8d7da; color: #721c24'] * len(row)
-                elif row.status == 'due':
-                     style = ['background-color: #fff3cd; color: #856404'] * len(row)
-                return style
-            return df_to_style.style.apply(style_status, axis=1)
-
-        display_df = df_filtered[['id', 'name', 'status', 'emi_amount', 'due_date', 'language']].copy()
-        display_df['emi_amount'] = display_df['emi_amount'].apply(lambda x: f"₹{x:,.0f}")
+            def style_all(d):
+                # One CSS string per row from whole-column masks, broadcast across every column
+                status = d['status']
+                is_due = status.eq('due')
+                row_css = np.select(
+                    [status.eq('paid'), status.eq('rescheduled'), is_due & (d['due_date'] < STYLE_TODAY), is_due],
+                    ROW_STYLES, default='')
+                return pd.DataFrame(np.repeat(row_css[:, None], d.shape[1], axis=1), index=d.index, columns=d.columns)
+            # Values stay numeric/datetime; the Styler formats them only for display
+            return (df_to_style.style
+                    .apply(style_all, axis=None)
+                    .format({'emi_amount': '₹{:,.0f}', 'due_date': '{:%Y-%m-%d}'}))
+
+        # Style and render one page at a time; styling cost scales with the rows sent
+        n_pages = max(1, math.ceil(len(df_filtered) / TABLE_PAGE_SIZE))
+        page = st.number_input("Page", min_value=1, max_value=n_pages, value=1, step=1) if n_pages > 1 else 1
+        page_start = (page - 1) * TABLE_PAGE_SIZE
+        display_df = df_filtered.iloc[page_start:page_start + TABLE_PAGE_SIZE][['id', 'name', 'status', 'emi_amount', 'due_date', 'language']]
         styled_df = style_loan_table(display_df)
         st.dataframe(styled_df, use_container_width=True, hide_index=True)
+        if n_pages > 1:
+            st.caption(f"Rows {page_start + 1}-{page_start + len(display_df)} of {len(df_filtered)}")